@@ -1,19 +1,32 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import re
+import csv
+import io
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+# Optional faster CSV parsing
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+except ImportError:
+    pa_csv = None
 
 # Minimal page config
 st.set_page_config(page_title="CNC 2026 Email Consolidator", layout="wide")
 
 # --- HELPER FUNCTIONS ---
+SHEET_URL_PATTERN = re.compile(r'/spreadsheets/d/([a-zA-Z0-9-_]+)(?:/.*?gid=([0-9]+))?')
+
 def extract_sheet_id_and_gid(url):
     """Extract spreadsheet ID and sheet GID from Google Sheets URL"""
-    pattern = r'/spreadsheets/d/([a-zA-Z0-9-_]+)(?:/.*?gid=([0-9]+))?'
-    match = re.search(pattern, url)
+    match = SHEET_URL_PATTERN.search(url)
     if match:
-        sheet_id = match.group(1)
-        gid = match.group(2) if match.group(2) else '0'
-        return sheet_id, gid
+        return match.group(1), match.group(2) or '0'
     return None, None
 
 def convert_to_csv_url(sheet_url):
@@ -23,98 +36,172 @@ def convert_to_csv_url(sheet_url):
         return f"https://docs.google.com/spreadsheets/d/{sheet_id}/export?format=csv&gid={gid}"
     return None
 
-def load_google_sheet_individual(url):
-    """Load individual registration data"""
-    csv_url = convert_to_csv_url(url)
-    if csv_url:
-        try:
-            df = pd.read_csv(csv_url)
-            return df
-        except Exception as e:
-            return None
-    return None
+# Fixed Google Sheets URLs (CSV export URLs are resolved once at import)
+INDIVIDUAL_URL = "https://docs.google.com/spreadsheets/d/1_Sz7pJgOHwzkhepIYS05Z-azYylI0lpjzdisFwcEo6U/edit?gid=1692911100#gid=1692911100"
+CITY_URL = "https://docs.google.com/spreadsheets/d/1mWFNjaYJ-CAM63jJiKlnRAVC7sdzekHFajzTIGR56Mk/edit?gid=1473544593#gid=1473544593"
+INDIVIDUAL_CSV_URL = convert_to_csv_url(INDIVIDUAL_URL)
+CITY_CSV_URL = convert_to_csv_url(CITY_URL)
 
-def load_google_sheet_city(url):
-    """Load city registration data and extract organizer info"""
-    csv_url = convert_to_csv_url(url)
-    if csv_url:
-        try:
-            df = pd.read_csv(csv_url)
-            # Skip first row (headers are malformed)
-            df = df.iloc[1:].reset_index(drop=True)
-            
-            # Extract organizer data from multiple columns
-            organizers = []
-            organizer_cols = [
-                ('Unnamed: 9', 'Unnamed: 10'),   # Organizer 1
-                ('Unnamed: 11', 'Unnamed: 12'),  # Organizer 2
-                ('Unnamed: 13', 'Unnamed: 14'),  # Organizer 3
-                ('Unnamed: 15', 'Unnamed: 16'),  # Organizer 4
-                ('Unnamed: 17', 'Unnamed: 18'),  # Organizer 5
-                ('Unnamed: 19', 'Unnamed: 20'),  # Organizer 6
-                ('Unnamed: 21', 'Unnamed: 22'),  # Organizer 7
-            ]
-            
-            for _, row in df.iterrows():
-                city_name = row['Unnamed: 1']
-                country = row['If you have changes, additions, or edits to other columns, please leave a comment in the cell where you would like a change and our team can make that change for you. Thank you, The CNC Global Organizing Team.']
-                
-                for name_col, email_col in organizer_cols:
-                    name = row.get(name_col)
-                    email = row.get(email_col)
-                    
-                    if pd.notna(email) and '@' in str(email):
-                        organizers.append({
-                            'Full Name': name if pd.notna(name) else 'Unknown',
-                            'Email': email,
-                            'Country': country if pd.notna(country) else 'Unknown',
-                            'City Name: This is the name of the nearest or largest metropolitan area anchoring your project (it may be a large city or a small rural town). If multiple cities are listed, please separate each city with a semi colon (;). Example: Minneapolis; St. Paul': city_name if pd.notna(city_name) else 'Unknown'
-                        })
-            
-            return pd.DataFrame(organizers)
-        except Exception as e:
-            st.error(f"Error loading City sheet: {e}")
-            return None
-    return None
+# Rows rendered in the results table before "Show all" is switched on
+PREVIEW_ROWS = 500
 
-def clean_email(email):
-    """Clean and validate email"""
-    if pd.isna(email):
+def parse_csv(data, usecols):
+    """Parse CSV bytes into string columns, keeping only the columns selected by usecols"""
+    if pa_csv is None:
+        return pd.read_csv(io.BytesIO(data), usecols=usecols, dtype='string')
+    
+    # Read only the header row and name blank/duplicate headers the way pandas does
+    # ("Unnamed: N", "Name.1"), so both paths expose the same columns
+    header = next(csv.reader(io.TextIOWrapper(io.BytesIO(data), encoding='utf-8-sig', newline='')), [])
+    names = []
+    for i, name in enumerate(header):
+        name = name or f'Unnamed: {i}'
+        base, n = name, 0
+        while name in names:
+            n += 1
+            name = f'{base}.{n}'
+        names.append(name)
+    selected = usecols if callable(usecols) else set(usecols).__contains__
+    keep = [name for name in names if selected(name)]
+    
+    # PyArrow's multi-threaded reader; only the selected columns are materialized, as text
+    table = pa_csv.read_csv(
+        io.BytesIO(data),
+        read_options=pa_csv.ReadOptions(column_names=names, skip_rows_after_names=1),
+        parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=keep,
+            column_types={name: pa.string() for name in keep},
+            strings_can_be_null=True,
+        ),
+    )
+    
+    # Arrow-backed string columns skip the copy into Python objects, and pd.concat later just
+    # stitches their Arrow chunks together instead of copying every cell
+    return table.to_pandas(types_mapper={pa.string(): pd.StringDtype('pyarrow')}.get)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_csv_bytes(csv_url, retries=3):
+    """Download a CSV export (gzip-compressed on the wire), cached for 5 minutes"""
+    # Each download gets its own session (they run on separate worker threads), which
+    # keeps the connection open across retries
+    with requests.Session() as session:
+        # Back off and retry when Google rate-limits the parallel export requests
+        for attempt in range(retries + 1):
+            response = session.get(csv_url, timeout=30)
+            if response.status_code != 429 or attempt == retries:
+                break
+            time.sleep(2 ** attempt)
+    response.raise_for_status()
+    return response.content
+
+def keep_valid_emails(df):
+    """Drop rows without a valid email and add the cleaned address as Email_clean"""
+    emails = df['Email'].str.strip().str.lower()
+    valid = emails.str.contains('@', regex=False, na=False)
+    return df.loc[valid].assign(Email_clean=emails[valid].array)
+
+def load_google_sheet_individual(csv_url):
+    """Load individual registration data from its CSV export URL"""
+    try:
+        return parse_individual_sheet(fetch_csv_bytes(csv_url))
+    except Exception as e:
         return None
-    email = str(email).strip().lower()
-    if '@' in email:
-        return email
-    return None
 
+@st.cache_data(max_entries=4, show_spinner=False)
+def parse_individual_sheet(data):
+    """Parse individual registration CSV bytes"""
+    # Only parse the name, email and country columns
+    df = parse_csv(data, usecols=lambda col: col in ('Full Name', 'Email') or 'Country' in col)
+    
+    # Clean emails up front so only valid rows are cached and combined
+    return keep_valid_emails(df)
+
+def load_google_sheet_city(csv_url):
+    """Load city registration data from its CSV export URL and extract organizer info"""
+    try:
+        return parse_city_sheet(fetch_csv_bytes(csv_url))
+    except Exception as e:
+        st.error(f"Error loading City sheet: {e}")
+        return None
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def parse_city_sheet(data):
+    """Parse city registration CSV bytes into one row per organizer"""
+    # Organizer name/email column pairs
+    organizer_cols = [
+        ('Unnamed: 9', 'Unnamed: 10'),   # Organizer 1
+        ('Unnamed: 11', 'Unnamed: 12'),  # Organizer 2
+        ('Unnamed: 13', 'Unnamed: 14'),  # Organizer 3
+        ('Unnamed: 15', 'Unnamed: 16'),  # Organizer 4
+        ('Unnamed: 17', 'Unnamed: 18'),  # Organizer 5
+        ('Unnamed: 19', 'Unnamed: 20'),  # Organizer 6
+        ('Unnamed: 21', 'Unnamed: 22'),  # Organizer 7
+    ]
+    country_col = 'If you have changes, additions, or edits to other columns, please leave a comment in the cell where you would like a change and our team can make that change for you. Thank you, The CNC Global Organizing Team.'
+    city_col = 'City Name: This is the name of the nearest or largest metropolitan area anchoring your project (it may be a large city or a small rural town). If multiple cities are listed, please separate each city with a semi colon (;). Example: Minneapolis; St. Paul'
+    
+    # Only parse the columns used below
+    usecols = [country_col, 'Unnamed: 1'] + [col for pair in organizer_cols for col in pair]
+    df = parse_csv(data, usecols=usecols)
+    # Skip first row (headers are malformed)
+    df = df.iloc[1:].reset_index(drop=True)
+    
+    # Stack each organizer's name/email pair under common columns
+    pieces = [
+        df[[name_col, email_col, country_col, 'Unnamed: 1']].set_axis(
+            ['Full Name', 'Email', 'Country', city_col], axis=1
+        )
+        for name_col, email_col in organizer_cols
+    ]
+    # Stable sort on the original row index keeps sheet order (row by row, organizer 1-7)
+    organizers = pd.concat(pieces).sort_index(kind='stable')
+    
+    # Keep only entries with a valid email address
+    organizers = keep_valid_emails(organizers)
+    organizers = organizers.fillna({'Full Name': 'Unknown', 'Country': 'Unknown', city_col: 'Unknown'})
+    
+    return organizers.reset_index(drop=True)
+
+# Categorical dtypes turn the sorting, filtering and unique counts into integer code ops
+SOURCE_DTYPE = pd.CategoricalDtype(['Both Sheets', 'Individual Registration', 'City Registration'], ordered=True)
+BOTH_CODE = SOURCE_DTYPE.categories.get_loc('Both Sheets')
+INDIVIDUAL_CODE = SOURCE_DTYPE.categories.get_loc('Individual Registration')
+CITY_CODE = SOURCE_DTYPE.categories.get_loc('City Registration')
+
+def hash_frame(df):
+    """Cache key covering every row (Streamlit's default hasher samples frames over 50k rows)"""
+    return tuple(df.columns), pd.util.hash_pandas_object(df).values.tobytes()
+
+@st.cache_data(max_entries=4, show_spinner=False, hash_funcs={pd.DataFrame: hash_frame})
 def process_dataframes(df_individual, df_city):
     """Combine and clean dataframes with proper source tracking"""
     if df_individual is None and df_city is None:
         return None
     
-    # Track which emails appear in which sheets
-    individual_emails = set()
-    city_emails = set()
+    # Track which emails appear in which sheets (loaders already dropped invalid emails)
+    individual_emails = pd.Index([])
+    city_emails = pd.Index([])
     
     if df_individual is not None:
-        df_individual['Email_clean'] = df_individual['Email'].apply(clean_email)
-        individual_emails = set(df_individual['Email_clean'].dropna())
+        individual_emails = pd.Index(df_individual['Email_clean'])
     
     if df_city is not None:
-        df_city['Email_clean'] = df_city['Email'].apply(clean_email)
-        city_emails = set(df_city['Email_clean'].dropna())
+        city_emails = pd.Index(df_city['Email_clean'])
     
     # Determine source for each email
-    emails_in_both = individual_emails & city_emails
+    emails_in_both = individual_emails.intersection(city_emails)
     
-    # Add source column to each dataframe
+    # Add source column to each dataframe, built directly as category codes so no per-row
+    # strings are created (the shared dtype also keeps it categorical through the concat)
     if df_individual is not None:
-        df_individual['Source'] = df_individual['Email_clean'].apply(
-            lambda x: 'Both Sheets' if x in emails_in_both else 'Individual Registration'
+        df_individual['Source'] = pd.Categorical.from_codes(
+            np.where(df_individual['Email_clean'].isin(emails_in_both), BOTH_CODE, INDIVIDUAL_CODE), dtype=SOURCE_DTYPE
         )
     
     if df_city is not None:
-        df_city['Source'] = df_city['Email_clean'].apply(
-            lambda x: 'Both Sheets' if x in emails_in_both else 'City Registration'
+        df_city['Source'] = pd.Categorical.from_codes(
+            np.where(df_city['Email_clean'].isin(emails_in_both), BOTH_CODE, CITY_CODE), dtype=SOURCE_DTYPE
         )
     
     # Combine dataframes
@@ -129,93 +216,135 @@ def process_dataframes(df_individual, df_city):
     
     combined_df = pd.concat(dfs, ignore_index=True)
     
-    # Clean and filter
-    combined_df = combined_df[combined_df['Email_clean'].notna()]
-    
     # Detect country column
-    country_cols = [c for c in combined_df.columns if "Country" in c]
-    if country_cols:
-        combined_df['Country'] = combined_df[country_cols[0]]
+    country_col = next((c for c in combined_df.columns if "Country" in c), None)
+    if country_col:
+        combined_df['Country'] = combined_df[country_col]
     else:
         combined_df['Country'] = "Unknown"
     
-    # Deduplicate by email, keeping first occurrence (preserves "Both Sheets" when applicable)
-    # Sort by Source first so "Both Sheets" comes first
-    combined_df['Source_priority'] = combined_df['Source'].apply(lambda x: 0 if x == 'Both Sheets' else 1)
-    combined_df = combined_df.sort_values('Source_priority')
-    unique_df = combined_df.drop_duplicates(subset=['Email_clean'], keep='first')
+    # Deduplicate by email, keeping the first occurrence. Every row of an email carries the
+    # same Source ("Both Sheets" is set on both sides), so a single-column duplicated() mask
+    # is enough and no sort or groupby is needed
+    unique_df = combined_df.loc[~combined_df['Email_clean'].duplicated(keep='first')]
+    
+    # Countries of the remaining rows, in sorted order, double as the filter options in the UI
+    countries = sorted(unique_df['Country'].dropna().unique())
+    unique_df = unique_df.assign(Country=unique_df['Country'].astype(pd.CategoricalDtype(countries, ordered=True)))
     
     # Final sort by Country then Full Name
     unique_df = unique_df.sort_values(by=['Country', 'Full Name'], ascending=[True, True])
     
-    # Drop helper columns
-    unique_df = unique_df.drop(['Email_clean', 'Source_priority'], axis=1)
+    # Drop helper column
+    unique_df = unique_df.drop('Email_clean', axis=1)
     
     return unique_df
 
+def build_downloads(df):
+    """Build the copy text and the CSV / plain text download bytes for the displayed rows"""
+    has_email = df['Email'].notna()
+    has_name = has_email & df['Full Name'].notna()
+    
+    named = df.loc[has_name, ['Full Name', 'Email']].astype('string')
+    emails_string = (named['Full Name'] + ' <' + named['Email'] + '>').str.cat(sep='; ')
+    
+    csv_data = df.to_csv(index=False).encode('utf-8')
+    
+    # Raw tab-separated fields with no quoting or escaping and no trailing newline, like the
+    # original per-row join. Tabs and line breaks inside a field become a space so every
+    # record stays on one line with four columns
+    fields = df.loc[has_email, ['Full Name', 'Email', 'Source', 'Country']].astype('string')
+    fields = fields.replace({r'[\t\r\n]+': ' '}, regex=True)
+    plain_text = fields.to_csv(
+        sep='\t', header=False, index=False, lineterminator='\n',
+        quoting=csv.QUOTE_NONE, quotechar=None,
+    ).removesuffix('\n').encode('utf-8')
+    
+    return emails_string, csv_data, plain_text
+
 # --- MAIN APP ---
 def main():
-    # Title and Load Button side by side
-    col1, col2 = st.columns([3, 1])
+    # Title and Load/Refresh Buttons side by side
+    col1, col2, col3 = st.columns([3, 1, 1])
     with col1:
         st.title("CNC 2026 Email Consolidator")
     with col2:
         st.write("")  # Spacing
         load_button = st.button("Load Data", type="primary", use_container_width=True)
-    
-    # Fixed Google Sheets URLs
-    INDIVIDUAL_URL = "https://docs.google.com/spreadsheets/d/1_Sz7pJgOHwzkhepIYS05Z-azYylI0lpjzdisFwcEo6U/edit?gid=1692911100#gid=1692911100"
-    CITY_URL = "https://docs.google.com/spreadsheets/d/1mWFNjaYJ-CAM63jJiKlnRAVC7sdzekHFajzTIGR56Mk/edit?gid=1473544593#gid=1473544593"
+    with col3:
+        st.write("")  # Spacing
+        refresh_button = st.button("Force Refresh", use_container_width=True)
     
     # Initialize session state
     if 'result_df' not in st.session_state:
         st.session_state.result_df = None
+        st.session_state.country_rows = {}
+        st.session_state.exports = {}
     
-    # Load data when button clicked
-    if load_button:
+    # Drop cached sheet downloads so the next load fetches fresh data
+    if refresh_button:
+        fetch_csv_bytes.clear()
+    
+    # Load data when button clicked (downloads are cached for 5 minutes)
+    if load_button or refresh_button:
         with st.spinner("Loading..."):
-            df_individual = load_google_sheet_individual(INDIVIDUAL_URL)
-            df_city = load_google_sheet_city(CITY_URL)
+            # Download both sheets in parallel; workers share the script context so
+            # cached calls and error messages still reach this session
+            ctx = get_script_run_ctx()
+            with ThreadPoolExecutor(max_workers=2, initializer=add_script_run_ctx, initargs=(None, ctx)) as executor:
+                future_individual = executor.submit(load_google_sheet_individual, INDIVIDUAL_CSV_URL)
+                future_city = executor.submit(load_google_sheet_city, CITY_CSV_URL)
+                df_individual, df_city = future_individual.result(), future_city.result()
             
             if df_individual is not None or df_city is not None:
                 result_df = process_dataframes(df_individual, df_city)
                 if result_df is not None and not result_df.empty:
+                    # Row positions per country are computed once per load, so filter reruns
+                    # only do dict lookups for the metrics and the filtered view
+                    country_rows = result_df.groupby('Country', observed=True, sort=False).indices
                     st.session_state.result_df = result_df
-                    st.success(f"✓ Loaded {len(result_df)} unique emails from {result_df['Country'].nunique()} countries")
+                    st.session_state.country_rows = country_rows
+                    st.session_state.exports = {}
+                    st.success(f"✓ Loaded {len(result_df)} unique emails from {len(country_rows)} countries")
             else:
                 st.error("Failed to load data. Check sheet permissions.")
     
     # Display results if available
     if st.session_state.result_df is not None:
         result_df = st.session_state.result_df
+        country_rows = st.session_state.country_rows
         
         # Filters and metrics in one row
         col1, col2, col3 = st.columns([2, 1, 1])
         
         with col1:
-            countries = ['All'] + sorted(result_df['Country'].dropna().unique().tolist())
+            countries = ['All'] + result_df['Country'].cat.categories.tolist()
             selected_country = st.selectbox("Filter by Country", countries)
         
         with col2:
-            total_emails = len(result_df) if selected_country == 'All' else len(result_df[result_df['Country'] == selected_country])
+            total_emails = len(result_df) if selected_country == 'All' else len(country_rows[selected_country])
             st.metric("Unique Emails", total_emails)
         
         with col3:
-           total_countries = (result_df['Country'].nunique()if selected_country == 'All'else 1)
+           total_countries = (len(country_rows) if selected_country == 'All' else 1)
            st.metric("Countries Selected", total_countries)
     
-        # Apply filter
-        display_df = result_df.copy()
-        if selected_country != 'All':
-            display_df = display_df[display_df['Country'] == selected_country]
+        # Apply filter (no copy needed, the frame is only read below)
+        display_df = result_df if selected_country == 'All' else result_df.iloc[country_rows[selected_country]]
         
         # Display columns: Name, Email, Source, Country only (NO INDEX)
         display_columns = ['Full Name', 'Email', 'Source', 'Country']
         display_columns = [col for col in display_columns if col in display_df.columns]
         
+        # Only send the first rows to the browser unless the user asks for all of them
+        # (downloads below still cover every row)
+        table_df = display_df[display_columns]
+        if len(table_df) > PREVIEW_ROWS and not st.toggle("Show all rows"):
+            table_df = table_df.head(PREVIEW_ROWS)
+        
         # Show table WITHOUT index column
         st.dataframe(
-            display_df[display_columns].reset_index(drop=True), 
+            table_df.reset_index(drop=True), 
             use_container_width=True, 
             height=400,
             hide_index=True  # This removes the serial number column
@@ -225,24 +354,21 @@ def main():
         st.markdown("---")
         col1, col2, col3 = st.columns(3)
         
-        # Prepare data
-        all_emails_with_names = []
-        for _, row in display_df.iterrows():
-            if pd.notna(row['Email']) and pd.notna(row.get('Full Name')):
-                all_emails_with_names.append(f"{row['Full Name']} <{row['Email']}>")
-        emails_string = '; '.join(all_emails_with_names)
+        # Prepare data once per country for the loaded data, so reruns reuse the serialized
+        # output without re-hashing the frame
+        exports = st.session_state.exports
+        if selected_country not in exports:
+            exports[selected_country] = build_downloads(display_df[display_columns])
+        emails_string, csv_data, plain_text = exports[selected_country]
         
         with col1:
             st.text_area("Copy Emails with Names", emails_string, height=100)
         
         with col2:
-            csv = display_df[display_columns].to_csv(index=False)
             filename = f"cnc_emails_{selected_country.lower().replace(' ', '_')}.csv" if selected_country != 'All' else "cnc_emails_all.csv"
-            st.download_button("Download Full Data (CSV)", csv, filename, "text/csv", use_container_width=True)
+            st.download_button("Download Full Data (CSV)", csv_data, filename, "text/csv", use_container_width=True)
         
         with col3:
-            plain_text = '\n'.join([f"{row['Full Name']}\t{row['Email']}\t{row['Source']}\t{row['Country']}" 
-                                    for _, row in display_df.iterrows() if pd.notna(row['Email'])])
             filename_txt = f"cnc_emails_{selected_country.lower().replace(' ', '_')}.txt" if selected_country != 'All' else "cnc_emails_all.txt"
             st.download_button("Download Plain Text", plain_text, filename_txt, "text/plain", use_container_width=True)
 